@@ -16,7 +16,7 @@ sudo apt-get install -y python3-pip python3-dev libasound2-dev libjack-dev rsync
 
 # Install Python packages
 echo "Installing Python packages..."
-/home/chris/midi_recorder_venv/bin/pip3 install mido python-rtmidi psutil
+/home/chris/midi_recorder_venv/bin/pip3 install mido python-rtmidi
 
 # Create directories
 echo "Creating directories..."
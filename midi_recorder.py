@@ -9,14 +9,19 @@ import sys
 import time
 import signal
 import logging
-import threading
+import logging.handlers
 import queue
+from collections import deque
+import threading
+import ctypes
+import ctypes.util
+import struct
+import glob
+import select
 from datetime import datetime
 from pathlib import Path
 from sdnotify import SystemdNotifier
 import mido
-from mido import MidiFile, MidiTrack, Message, MetaMessage
-import psutil
 
 # Configuration
 BASE_DIR = Path("/home/chris/midi_recordings")
@@ -27,28 +32,198 @@ TICKS_PER_BEAT = 480
 LOW_BLACK_NOTE = 22   # A#0/Bb0
 HIGH_BLACK_NOTE = 106  # A#7/Bb7
 SHORTCUT_TIMEOUT = 1.0  # seconds between shortcut presses
+SHORTCUT_BUFFER_SIZE = 16  # a triple press needs at most 6 held messages
+HOLD_TIME = 2.0  # seconds a lone first note must last to count as a session
+# Timestamps are integer perf_counter_ns() readings; ticks = ns * NUM // DEN
+_NS_PER_SEC = 1_000_000_000
+_NS_TO_TICKS_NUM = TICKS_PER_BEAT
+_NS_TO_TICKS_DEN = DEFAULT_TEMPO * 1_000
+_SESSION_TIMEOUT_NS = SESSION_TIMEOUT * _NS_PER_SEC
+_SHORTCUT_TIMEOUT_NS = int(SHORTCUT_TIMEOUT * _NS_PER_SEC)
+_HOLD_TIME_NS = int(HOLD_TIME * _NS_PER_SEC)
+MAIN_RT_PRIORITY = 80  # SCHED_FIFO priority, inherited by the rtmidi thread
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+SND_DEVICE_DIR = b"/dev/snd"
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+PORT_RETRIES = 5  # rescans, one per second, after a device change
+_SHORTCUT_NOTES = (LOW_BLACK_NOTE, HIGH_BLACK_NOTE)
+GOVERNOR_GLOB = "/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_governor"
+FLUSH_EVENTS = 64  # flush the write buffer after this many events
+FLUSH_INTERVAL = 2.0  # ...or after this many seconds
+_FLUSH_INTERVAL_NS = int(FLUSH_INTERVAL * _NS_PER_SEC)
 
 notifier = SystemdNotifier()
 notifier.notify("READY=1")
 
+_NOTE_STATUS = {'note_off': 0x80, 'note_on': 0x90}
+
+def _encode_vlq(n):
+    """Encode a delta time as a MIDI variable-length quantity"""
+    if n < 0x80:
+        return bytes((n,))
+    out = [n & 0x7f]
+    n >>= 7
+    while n:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    return bytes(reversed(out))
+
+def _encode_event(status, data1, data2):
+    """Encode a three-byte channel voice message"""
+    return bytes((status, data1, data2))
+
+class _ShortcutState:
+    """Press tracking for one shortcut key"""
+
+    __slots__ = ('count', 'buffer', 'last_time', 'note', 'suffix')
+
+    def __init__(self, note, suffix):
+        self.note = note
+        self.suffix = suffix
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.buffer = deque(maxlen=SHORTCUT_BUFFER_SIZE)
+        self.last_time = 0
+
+class StreamingMidiWriter:
+    """Write a single-track MIDI file incrementally
+
+    write() only serializes events into an in-memory buffer, so it is safe
+    to call from the MIDI callback. The main loop hands the buffer over
+    with take() every FLUSH_EVENTS events or FLUSH_INTERVAL seconds and
+    does the disk work (open, write_out, close) without holding the
+    recorder lock. The MTrk length is patched after every write, so a file
+    cut short by a power loss is still readable up to the last flush.
+    """
+
+    HEADER_SIZE = 22  # MThd chunk (14 bytes) + MTrk chunk header (8 bytes)
+    TRACK_LENGTH_OFFSET = 18
+
+    def __init__(self, session_time, ticks_per_beat=TICKS_PER_BEAT, tempo=DEFAULT_TEMPO):
+        self.session_time = session_time  # datetime used for the file name
+        self.ticks_per_beat = ticks_per_beat
+        self.path = None
+        self.fd = None
+        self.buffer = bytearray()
+        self.track_length = 0
+        self.events = 0
+        self.pending = 0
+        self.last_flush = time.perf_counter_ns()
+
+        # Tempo meta message at delta 0
+        self.buffer += b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big')
+
+    def write(self, msg, delta_ticks):
+        """Append a channel message with the given delta time"""
+        self.buffer += _encode_vlq(delta_ticks)
+        status = _NOTE_STATUS.get(msg.type)
+        if status is not None:
+            self.buffer += _encode_event(status | msg.channel, msg.note, msg.velocity)
+        else:
+            self.buffer += msg.bin()
+        self.events += 1
+        self.pending += 1
+
+    def flush_due(self):
+        """Whether enough events or time have piled up to hit the disk"""
+        return self.pending >= FLUSH_EVENTS or \
+            (self.pending and time.perf_counter_ns() - self.last_flush > _FLUSH_INTERVAL_NS)
+
+    def finish(self):
+        """Append end-of-track; the next take() returns the final bytes"""
+        self.buffer += b'\x00\xff\x2f\x00'
+
+    def take(self):
+        """Swap out the buffered bytes for write_out()"""
+        data = self.buffer
+        self.buffer = bytearray()
+        self.pending = 0
+        self.last_flush = time.perf_counter_ns()
+        return data
+
+    def restore(self, data):
+        """Put back bytes from take() that could not be written"""
+        self.buffer[:0] = data
+        self.pending = max(self.pending, 1)
+
+    def open(self, path):
+        """Create the file and write the MThd and MTrk headers"""
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        header = b'MThd' + struct.pack('>IHHH', 6, 0, 1, self.ticks_per_beat)
+        header += b'MTrk' + struct.pack('>I', 0)
+        try:
+            os.write(fd, header)
+        except OSError:
+            os.close(fd)
+            raise
+        self.fd = fd
+        self.path = path
+
+    def write_out(self, data):
+        """Write bytes from take() and update the track length
+
+        The length is only committed once everything succeeded, so a failed
+        call can be retried with the same data.
+        """
+        if data:
+            track_length = self.track_length + len(data)
+            os.pwrite(self.fd, data, self.HEADER_SIZE + self.track_length)
+            os.pwrite(self.fd, struct.pack('>I', track_length),
+                      self.TRACK_LENGTH_OFFSET)
+            os.fdatasync(self.fd)
+            self.track_length = track_length
+
+    def close(self):
+        os.close(self.fd)
+        self.fd = None
+
 class MidiRecorder:
     def __init__(self):
         self.recording = False
         self.last_activity = None
         self.current_file = None
-        self.current_track = None
+        self.held_messages = []
+        self.held_note_ons = 0
+        self.finished_files = []  # (writer, suffix, duration) awaiting close
+        self.session_dir = None
+        self.session_time = None
         self.session_start_time = None
         self.first_message_time = None
         self.last_message_time = None
+        self.tick_origin = None
+        self.last_ticks = 0
         self.midi_port = None
         self.running = True
         self.in_low_power = False
-        self.message_queue = queue.Queue()
-        self.low_note_state = {'count': 0, 'buffer': [], 'last_time': 0}
-        self.high_note_state = {'count': 0, 'buffer': [], 'last_time': 0}
+        self.current_port_name = None
+        self.ports_changed = True  # scan once at startup
+        self.port_retries = PORT_RETRIES
+        self.device_watch = None
+        self.lock = threading.RLock()
+        self.low_note_state = _ShortcutState(LOW_BLACK_NOTE, '')
+        self.high_note_state = _ShortcutState(HIGH_BLACK_NOTE, '-bookmark')
+        self.handlers = {
+            'note_on': self._on_note,
+            'note_off': self._on_note,
+            'polytouch': self._on_passthrough,
+            'control_change': self._on_passthrough,
+            'program_change': self._on_passthrough,
+            'aftertouch': self._on_passthrough,
+            'pitchwheel': self._on_passthrough,
+        }
         
         # Setup logging
         self.setup_logging()
+        self.governor_fds = self.open_governor_files()
+        self.governor_pending = None
+        # Lets the MIDI callback wake the main loop early (see wake_main_loop)
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
         
         # Setup signal handlers
         signal.signal(signal.SIGTERM, self.signal_handler)
@@ -59,30 +234,159 @@ class MidiRecorder:
         log_dir = Path("/var/log/midi_recorder")
         log_dir.mkdir(exist_ok=True)
         
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_dir / "midi_recorder.log"),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        file_handler = logging.FileHandler(log_dir / "midi_recorder.log")
+        file_handler.setFormatter(formatter)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(formatter)
+
+        # Callers only enqueue records; a background thread does the disk
+        # and stdout writes so the MIDI callback never blocks on the SD card
+        log_queue = queue.SimpleQueue()
+        root = logging.getLogger()
+        root.setLevel(logging.INFO)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        self.log_listener = logging.handlers.QueueListener(
+            log_queue, file_handler, stream_handler)
+        self.log_listener.start()
         self.logger = logging.getLogger(__name__)
         
+    def open_governor_files(self):
+        """Open the cpufreq governor files once so switching is a plain write"""
+        fds = []
+        for path in glob.glob(GOVERNOR_GLOB):
+            try:
+                fds.append(os.open(path, os.O_WRONLY))
+            except OSError as e:
+                self.logger.warning(f"Cannot open {path}: {e}")
+        return fds
+
+    def apply_governor(self):
+        """Apply a governor change requested under the lock
+
+        Runs on the main loop so the sysfs write never holds up the MIDI
+        callback.
+        """
+        with self.lock:
+            governor = self.governor_pending
+            self.governor_pending = None
+        if governor is not None:
+            self.set_governor(governor)
+
+    def set_governor(self, governor):
+        """Set the CPU frequency governor on all cores"""
+        value = governor.encode() + b'\n'
+        for fd in self.governor_fds:
+            try:
+                os.pwrite(fd, value, 0)
+            except OSError:
+                pass
+
     def signal_handler(self, sig, frame):
         """Handle shutdown signals gracefully"""
+        # run() saves the session and exits once the loop notices
         self.logger.info("Shutdown signal received")
         self.running = False
-        self.stop_recording()
-        sys.exit(0)
         
+    def set_realtime_priority(self, priority):
+        """Move the calling thread to SCHED_FIFO, falling back to SCHED_OTHER"""
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            return True
+        except (PermissionError, AttributeError, OSError) as e:
+            # Needs CAP_SYS_NICE (see AmbientCapabilities in the service file)
+            self.logger.warning(f"Could not set SCHED_FIFO priority {priority}: {e}")
+            return False
+
+    def lock_memory(self):
+        """Lock current and future pages in RAM to avoid page-fault jitter"""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+                errno = ctypes.get_errno()
+                self.logger.warning(f"mlockall failed: {os.strerror(errno)}")
+                return False
+            return True
+        except (OSError, AttributeError) as e:
+            self.logger.warning(f"mlockall unavailable: {e}")
+            return False
+
+    def open_device_watch(self):
+        """Watch /dev/snd with inotify so ports are only rescanned on change"""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if libc.inotify_add_watch(fd, SND_DEVICE_DIR, IN_CREATE | IN_DELETE) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, "inotify_add_watch failed")
+            return fd
+        except (OSError, AttributeError) as e:
+            self.logger.warning(f"Device watch unavailable, polling ports: {e}")
+            return None
+
+    def wake_main_loop(self):
+        """Interrupt the main loop's wait from another thread"""
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:
+            pass  # already has a wakeup pending
+
+    def wait_for_device_change(self, timeout):
+        """Sleep up to timeout seconds, waking early on a device change or wakeup"""
+        fds = [self.wake_r]
+        if self.device_watch is not None:
+            fds.append(self.device_watch)
+
+        readable, _, _ = select.select(fds, [], [], timeout)
+        if self.wake_r in readable:
+            try:
+                while os.read(self.wake_r, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+        if self.device_watch is None:
+            self.ports_changed = True
+        elif self.device_watch in readable:
+            # Drain all queued events; one rescan covers them
+            try:
+                while os.read(self.device_watch, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            self.ports_changed = True
+            self.port_retries = PORT_RETRIES
+
     def midi_callback(self, msg):
         """Callback for incoming MIDI messages"""
         # Get timestamp as close to receipt as possible
-        timestamp = time.perf_counter()
-        # Add message to queue with high-precision timestamp
-        self.message_queue.put((msg, timestamp))
+        timestamp = time.perf_counter_ns()
+        # Types without a handler (clock, active sensing, ...) are dropped
+        handler = self.handlers.get(msg.type)
+        if handler is not None:
+            # Process inline; the lock only guards against the timeout and
+            # shutdown paths on the main thread
+            with self.lock:
+                try:
+                    handler(msg, timestamp)
+                except Exception as e:
+                    # Nothing above us would log this; drop the session
+                    # instead of leaving it half-stopped
+                    self.logger.error(f"Error handling MIDI message: {e}")
+                    self.abort_recording()
         
+    def open_port(self, port_name):
+        """Open an input port and drop sysex/clock/active sensing in C"""
+        port = mido.open_input(port_name, callback=self.midi_callback)
+        rt = getattr(port, '_rt', None)  # only the rtmidi backend has this
+        if rt is not None:
+            rt.ignore_types(sysex=True, timing=True, active_sense=True)
+        return port
+
     def find_midi_port(self):
         """Find and connect to MIDI input port"""
         try:
@@ -106,83 +410,97 @@ class MidiRecorder:
             
             # Open port with callback
             # Note: mido with python-rtmidi backend provides best timing
-            return mido.open_input(port_name, callback=self.midi_callback)
+            return self.open_port(port_name)
             
         except Exception as e:
             self.logger.error(f"Error opening MIDI port: {e}")
             return None
             
-    def create_session_path(self):
+    def create_session_path(self, now):
         """Create directory structure and return session file path"""
-        now = datetime.now()
         year = now.strftime("%Y")
         month = now.strftime("%m-%B")
         day = now.strftime("%d")
         
         dir_path = BASE_DIR / year / month / day
-        dir_path.mkdir(parents=True, exist_ok=True)
+        if dir_path != self.session_dir:
+            dir_path.mkdir(parents=True, exist_ok=True)
+            self.session_dir = dir_path
         
         # Create session filename with timestamp
-        session_name = now.strftime("session_%H%M%S.mid")
-        return dir_path / session_name
+        session_name = now.strftime("session_%H%M%S")
+        file_path = dir_path / (session_name + ".mid")
+        # Files are named after the session start, so don't clobber a
+        # session that started within the same second
+        n = 1
+        while file_path.exists():
+            file_path = dir_path / f"{session_name}-{n}.mid"
+            n += 1
+        return file_path
         
     def start_recording(self):
         """Start a new recording session"""
         if self.recording:
             return
             
-        self.session_start_time = time.perf_counter()
-        self.last_activity = time.time()
+        self.session_start_time = time.perf_counter_ns()
+        self.session_time = datetime.now()
+        self.last_activity = self.session_start_time
         self.first_message_time = None
         self.last_message_time = None
         
-        # Create new MIDI file with proper settings
-        self.current_file = MidiFile(ticks_per_beat=TICKS_PER_BEAT)
-        self.current_track = MidiTrack()
-        
-        # Add tempo meta message
-        tempo_msg = MetaMessage('set_tempo', tempo=DEFAULT_TEMPO, time=0)
-        self.current_track.append(tempo_msg)
-        
-        self.current_file.tracks.append(self.current_track)
+        # The writer is created by the second note_on, or once the first
+        # note has lasted HOLD_TIME (see _ensure_file_open), so a single
+        # stray key press never touches the disk
+        self.current_file = None
+        self.held_messages = []
+        self.held_note_ons = 0
         
         self.recording = True
-        self.in_low_power = False
         self.logger.info("Started new recording session")
         
-    def stop_recording(self, suffix="", skip_queue=False, skip_buffer=False):
+    def stop_recording(self, suffix="", skip_buffer=False):
         """Stop recording and save the file"""
+        with self.lock:
+            self._stop_recording(suffix, skip_buffer)
+
+    def _stop_recording(self, suffix, skip_buffer):
         if not self.recording:
             return
 
         self.recording = False
 
-        if skip_queue:
-            with self.message_queue.mutex:
-                self.message_queue.queue.clear()
-        else:
-            self.process_message_queue()
-
         if not skip_buffer:
             self.flush_shortcut_buffers()
         else:
-            self.low_note_state = {'count': 0, 'buffer': [], 'last_time': 0}
-            self.high_note_state = {'count': 0, 'buffer': [], 'last_time': 0}
-
-        if self.current_file and len(self.current_track) > 1:  # More than just tempo
-            file_path = self.create_session_path()
-            if suffix:
-                file_path = file_path.with_name(file_path.stem + suffix + file_path.suffix)
-            self.current_file.save(file_path)
-            self.logger.info(f"Saved recording to {file_path}")
+            self.low_note_state.reset()
+            self.high_note_state.reset()
 
-            duration = self.last_message_time - self.first_message_time if self.first_message_time else 0
-            self.logger.info(f"Session duration: {duration:.1f} seconds, "
-                           f"Messages: {len(self.current_track) - 1}")
+        self.held_messages = []
+        self.held_note_ons = 0
+        if self.current_file is None:
+            return
 
+        # The main loop writes the tail and closes the file (see sync_files)
+        duration = (self.last_message_time - self.first_message_time) / _NS_PER_SEC \
+            if self.first_message_time else 0
+        self.current_file.finish()
+        self.finished_files.append((self.current_file, suffix, duration))
         self.current_file = None
-        self.current_track = None
         
+    def abort_recording(self):
+        """Reset session state after a failure in the MIDI callback"""
+        self.recording = False
+        self.held_messages = []
+        self.held_note_ons = 0
+        self.low_note_state.reset()
+        self.high_note_state.reset()
+        if self.current_file is not None:
+            # Let the main loop close whatever made it to disk
+            self.current_file.finish()
+            self.finished_files.append((self.current_file, '', 0))
+            self.current_file = None
+
     def enter_low_power_mode(self):
         """Reduce resource usage when idle"""
         if not self.in_low_power:
@@ -190,10 +508,7 @@ class MidiRecorder:
             self.logger.info("Entering low power mode")
             
             # Reduce CPU governor if available (Pi specific)
-            try:
-                os.system("echo powersave | sudo tee /sys/devices/system/cpu/cpu*/cpufreq/scaling_governor > /dev/null 2>&1")
-            except:
-                pass
+            self.governor_pending = "powersave"
                 
     def exit_low_power_mode(self):
         """Return to normal operation"""
@@ -201,82 +516,100 @@ class MidiRecorder:
             self.in_low_power = False
             self.logger.info("Exiting low power mode")
             
-            # Restore CPU governor
-            try:
-                os.system("echo ondemand | sudo tee /sys/devices/system/cpu/cpu*/cpufreq/scaling_governor > /dev/null 2>&1")
-            except:
-                pass
+            # Restore CPU governor; the main loop may be in a long idle wait
+            self.governor_pending = "ondemand"
+            self.wake_main_loop()
                 
+    def _ensure_file_open(self, msg, msg_timestamp):
+        """Hold messages until the session is clearly more than a stray press
+
+        The writer is created on the second note_on, or on any message that
+        arrives HOLD_TIME after the first one. Returns False while messages
+        are being held back; once the writer exists the held messages have
+        been written and the caller writes msg.
+        """
+        if msg.type == 'note_on' and msg.velocity > 0:
+            self.held_note_ons += 1
+        held = self.held_messages
+        if self.held_note_ons < 2 and \
+                (not held or msg_timestamp - held[0][1] < _HOLD_TIME_NS):
+            held.append((msg, msg_timestamp))
+            return False
+
+        self.held_messages = []
+        self.held_note_ons = 0
+        self.current_file = StreamingMidiWriter(self.session_time)
+        self.tick_origin = held[0][1] if held else msg_timestamp
+        self.last_ticks = 0
+        for m, ts in held:
+            self._append_message(m, ts)
+        return True
+
     def write_message(self, msg, msg_timestamp):
         """Write a MIDI message to the current track with timing"""
-        if self.current_track is not None:
-            if self.last_message_time is None:
-                delta_seconds = 0
-            else:
-                delta_seconds = msg_timestamp - self.last_message_time
+        if self.current_file is None and \
+                not self._ensure_file_open(msg, msg_timestamp):
+            return
+        self._append_message(msg, msg_timestamp)
 
-            beats_per_second = 1000000.0 / DEFAULT_TEMPO
-            delta_ticks = int(delta_seconds * TICKS_PER_BEAT * beats_per_second)
-            delta_ticks = max(0, delta_ticks)
+    def _append_message(self, msg, msg_timestamp,
+                        _num=_NS_TO_TICKS_NUM, _den=_NS_TO_TICKS_DEN):
+        # Truncate the absolute position rather than each delta, so rounding
+        # never accumulates over a long session
+        abs_ticks = (msg_timestamp - self.tick_origin) * _num // _den
+        if abs_ticks > self.last_ticks:
+            delta_ticks = abs_ticks - self.last_ticks
+            self.last_ticks = abs_ticks
+        else:
+            delta_ticks = 0
 
-            msg_copy = msg.copy()
-            msg_copy.time = delta_ticks
-            self.current_track.append(msg_copy)
-            self.last_message_time = msg_timestamp
+        self.current_file.write(msg, delta_ticks)
+        self.last_message_time = msg_timestamp
 
     def flush_buffer(self, state):
-        for m, ts in state['buffer']:
+        for m, ts in state.buffer:
             self.write_message(m, ts)
-        state['buffer'].clear()
-        state['count'] = 0
-        state['last_time'] = 0
+        state.buffer.clear()
+        state.count = 0
+        state.last_time = 0
 
     def flush_shortcut_buffers(self):
         self.flush_buffer(self.low_note_state)
         self.flush_buffer(self.high_note_state)
 
+    def flush_pending_shortcuts(self):
+        """Write out shortcut presses that turned out to be regular playing"""
+        if self.low_note_state.count > 0:
+            self.flush_buffer(self.low_note_state)
+        if self.high_note_state.count > 0:
+            self.flush_buffer(self.high_note_state)
+
     def handle_shortcuts(self, msg, msg_timestamp):
-        """Handle bookmark and session end shortcuts"""
-        if msg.type in ['note_on', 'note_off']:
-            for note, state, suffix in [
-                (LOW_BLACK_NOTE, self.low_note_state, ''),
-                (HIGH_BLACK_NOTE, self.high_note_state, '-bookmark')
-            ]:
-                if msg.note == note:
-                    if msg.type == 'note_on' and state['count'] > 0 and \
-                            msg_timestamp - state['last_time'] > SHORTCUT_TIMEOUT:
-                        self.flush_buffer(state)
-                    state['buffer'].append((msg, msg_timestamp))
-                    if msg.type == 'note_on':
-                        state['count'] += 1
-                        state['last_time'] = msg_timestamp
-                        if state['count'] >= 3:
-                            with self.message_queue.mutex:
-                                self.message_queue.queue.clear()
-                            self.stop_recording(suffix=suffix,
-                                                skip_queue=True,
-                                                skip_buffer=True)
-                            return True
-                    return True
-
-            if self.low_note_state['count'] > 0:
-                self.flush_buffer(self.low_note_state)
-            if self.high_note_state['count'] > 0:
-                self.flush_buffer(self.high_note_state)
+        """Handle bookmark and session end shortcuts for a note message"""
+        if msg.note not in _SHORTCUT_NOTES:
+            self.flush_pending_shortcuts()
             return False
 
-        if self.low_note_state['count'] > 0:
-            self.flush_buffer(self.low_note_state)
-        if self.high_note_state['count'] > 0:
-            self.flush_buffer(self.high_note_state)
-        return False
+        if msg.note == self.low_note_state.note:
+            state = self.low_note_state
+        else:
+            state = self.high_note_state
 
-    def process_midi_message(self, msg, msg_timestamp):
-        """Process incoming MIDI message with accurate timing"""
-        if msg.type in ['clock', 'active_sensing']:
-            return
+        if msg.type == 'note_on' and state.count > 0 and \
+                msg_timestamp - state.last_time > _SHORTCUT_TIMEOUT_NS:
+            self.flush_buffer(state)
+        state.buffer.append((msg, msg_timestamp))
+        if msg.type == 'note_on':
+            state.count += 1
+            state.last_time = msg_timestamp
+            if state.count >= 3:
+                self.stop_recording(suffix=state.suffix,
+                                    skip_buffer=True)
+        return True
 
-        self.last_activity = time.time()
+    def begin_event(self, msg_timestamp):
+        """Record activity, starting a session if needed"""
+        self.last_activity = msg_timestamp
 
         if not self.recording:
             self.start_recording()
@@ -285,104 +618,150 @@ class MidiRecorder:
         if self.in_low_power:
             self.exit_low_power_mode()
 
+    def _on_note(self, msg, msg_timestamp):
+        self.begin_event(msg_timestamp)
         if not self.handle_shortcuts(msg, msg_timestamp):
             self.write_message(msg, msg_timestamp)
+
+    def _on_passthrough(self, msg, msg_timestamp):
+        self.begin_event(msg_timestamp)
+        self.flush_pending_shortcuts()
+        self.write_message(msg, msg_timestamp)
             
-    def process_message_queue(self):
-        """Process all messages in the queue"""
-        messages_processed = 0
-        
-        while not self.message_queue.empty():
+    def sync_files(self):
+        """Write buffered MIDI data to disk and close finished sessions
+
+        Only the buffer swap happens under the lock, so the MIDI callback
+        is never held up by an SD-card write or sync.
+        """
+        with self.lock:
+            work = []
+            if self.current_file is not None and self.current_file.flush_due():
+                work.append((self.current_file, self.current_file.take(), None))
+            for writer, suffix, duration in self.finished_files:
+                work.append((writer, writer.take(), (suffix, duration)))
+            self.finished_files = []
+
+        for writer, data, finished in work:
+            path = writer.path
             try:
-                msg, timestamp = self.message_queue.get_nowait()
-                self.process_midi_message(msg, timestamp)
-                messages_processed += 1
-            except queue.Empty:
-                break
-                
-        return messages_processed
-        
+                if writer.fd is None:
+                    path = self.create_session_path(writer.session_time)
+                    writer.open(path)
+                writer.write_out(data)
+            except OSError as e:
+                target = path or f"session started {writer.session_time}"
+                self.logger.error(f"Error writing recording {target}: {e}")
+                # Keep the data so the next pass retries it
+                with self.lock:
+                    writer.restore(data)
+                    if finished:
+                        self.finished_files.append((writer,) + finished)
+                continue
+
+            if not finished:
+                continue
+            suffix, duration = finished
+            try:
+                writer.close()
+                file_path = writer.path
+                if suffix:
+                    file_path = file_path.with_name(file_path.stem + suffix + file_path.suffix)
+                    os.rename(writer.path, file_path)
+            except OSError as e:
+                self.logger.error(f"Error finishing recording {writer.path}: {e}")
+                continue
+            self.logger.info(f"Saved recording to {file_path}")
+            self.logger.info(f"Session duration: {duration:.1f} seconds, "
+                             f"Messages: {writer.events}")
+
     def check_session_timeout(self):
         """Check if session has timed out"""
-        if self.recording and self.last_activity:
-            if time.time() - self.last_activity > SESSION_TIMEOUT:
-                self.logger.info("Session timeout - stopping recording")
-                self.stop_recording()
-                self.enter_low_power_mode()
+        with self.lock:
+            if self.recording and self.last_activity is not None:
+                if time.perf_counter_ns() - self.last_activity > _SESSION_TIMEOUT_NS:
+                    self.logger.info("Session timeout - stopping recording")
+                    self.stop_recording()
+                    self.enter_low_power_mode()
                 
     def run(self):
         """Main loop"""
         self.logger.info("MIDI Recorder starting...")
         self.logger.info(f"Using MIDI backend: {mido.backend.name}")
-        
-        # Start a separate thread for port monitoring
-        port_thread = threading.Thread(target=self.port_monitor_thread)
-        port_thread.daemon = True
-        port_thread.start()
-        
-        last_queue_check = time.perf_counter()
+
+        self.lock_memory()
+        if self.set_realtime_priority(MAIN_RT_PRIORITY):
+            self.logger.info(f"Running with SCHED_FIFO priority {MAIN_RT_PRIORITY}")
+        self.device_watch = self.open_device_watch()
         
         while self.running:
             try:
-                # Process messages more frequently when active
-                current_time = time.perf_counter()
-                
-                # Always process pending messages
-                messages = self.process_message_queue()
-                
-                # Check session timeout periodically
-                if current_time - last_queue_check > 1.0:
-                    self.check_session_timeout()
-                    notifier.notify("WATCHDOG=1")
-                    last_queue_check = current_time
+                # MIDI is handled in the callback; this loop only does
+                # port monitoring, timeout and watchdog housekeeping
+                if self.ports_changed:
+                    self.ports_changed = False
+                    self._poll_port()
+                    # The sequencer port can show up after the /dev/snd
+                    # node, without an event of its own; retry for a few
+                    # seconds, then go back to waiting on /dev/snd
+                    if self.midi_port is None and self.port_retries > 0:
+                        self.port_retries -= 1
+                        self.ports_changed = True
+                self.check_session_timeout()
+                self.apply_governor()
+                self.sync_files()
+                notifier.notify("WATCHDOG=1")
                 
                 # Sleep based on activity
-                if self.in_low_power:
-                    time.sleep(IDLE_CHECK_INTERVAL)
+                if self.in_low_power and not self.ports_changed:
+                    self.wait_for_device_change(IDLE_CHECK_INTERVAL)
                 else:
-                    # Very short sleep to maintain responsiveness
-                    # This allows near real-time processing while preventing CPU spinning
-                    time.sleep(0.001)  # 1ms
+                    self.wait_for_device_change(1.0)
                     
             except Exception as e:
                 self.logger.error(f"Error in main loop: {e}")
                 time.sleep(1)
-                
-    def port_monitor_thread(self):
-        """Monitor MIDI port connection in separate thread"""
-        self.current_port_name = None      # track the port name we’re using
-        while self.running:
+
+        # Shutdown: stop taking input, then save whatever is in progress
+        if self.midi_port:
             try:
-                ports = mido.get_input_names()
-
-                # still connected?
-                if (self.midi_port is None or
-                        self.current_port_name not in ports):
-                    # clean up old handle
-                    if self.midi_port:
-                        try:
-                            self.midi_port.close()
-                        except Exception:
-                            pass
-                        self.midi_port = None
-                        self.logger.info("MIDI port lost")
-
-                    # look for any port that contains “piano”
-                    port_name = next((p for p in ports
-                                      if 'pia' in p.lower()), None)
-
-                    if port_name:
-                        self.midi_port = mido.open_input(
-                            port_name, callback=self.midi_callback)
-                        self.current_port_name = port_name
-                        self.logger.info(f"Connected to {port_name}")
-                    else:
-                        self.current_port_name = None  # nothing available
-
-                time.sleep(1)           # adjust as needed
-            except Exception as e:
-                self.logger.error(f"Port monitor error: {e}")
-                time.sleep(2)
+                self.midi_port.close()
+            except Exception:
+                pass
+        self.stop_recording()
+        self.sync_files()
+        self.apply_governor()
+        self.log_listener.stop()
+                
+    def _poll_port(self):
+        """Reconnect to the MIDI port if it went away"""
+        try:
+            ports = mido.get_input_names()
+
+            # still connected?
+            if (self.midi_port is None or
+                    self.current_port_name not in ports):
+                # clean up old handle
+                if self.midi_port:
+                    try:
+                        self.midi_port.close()
+                    except Exception:
+                        pass
+                    self.midi_port = None
+                    self.logger.info("MIDI port lost")
+
+                # look for any port that contains “piano”
+                port_name = next((p for p in ports
+                                  if 'pia' in p.lower()), None)
+
+                if port_name:
+                    self.midi_port = self.open_port(port_name)
+                    self.current_port_name = port_name
+                    self.logger.info(f"Connected to {port_name}")
+                else:
+                    self.current_port_name = None  # nothing available
+        except Exception as e:
+            self.logger.error(f"Port monitor error: {e}")
 
 
 if __name__ == "__main__":